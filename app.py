@@ -1,33 +1,212 @@
+import eventlet
+eventlet.monkey_patch()
+
 from flask import Flask, render_template, request, jsonify
 import os
-from crewai import Agent, Task, Crew, Process
+from crewai import Agent, Task, Crew, Process, LLM
 from crewai_tools import SerperDevTool
 from flask_socketio import SocketIO
-from threading import Thread
+from threading import BoundedSemaphore, Semaphore
 import uuid
+import hashlib
+import json
+import diskcache
+import orjson
+from typing import Annotated
+from pydantic import AfterValidator, BaseModel, Field, ValidationError
+
+# The dumps/loads pair Socket.IO needs from its json module, backed by orjson. orjson output is
+# always compact, so separators is ignored; non-str dict keys are coerced like the stdlib does.
+class OrjsonModule:
+    @staticmethod
+    def dumps(obj, default=str, sort_keys=False, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+def normalize(value):
+    # "LLM Agents", " llm  agents " and "LLM agents." should share a cache entry
+    return ' '.join(value.casefold().split()).strip(' .!?')
+
+def require_text(value):
+    # Reject values like "", "   " or "?!" that would collapse to an empty cache key field
+    if not normalize(value):
+        raise ValueError('must not be empty')
+    return value.strip()
+
+FormField = Annotated[str, AfterValidator(require_text)]
+
+class GenerateRequest(BaseModel):
+    topic: FormField
+    content_type: FormField = Field(alias='contentType')
+    target_audience: FormField = Field(alias='targetAudience')
+    tone: FormField
 
 app = Flask(__name__)
-socketio = SocketIO(app)
+app.config['MAX_CONTENT_LENGTH'] = 8192
+socketio = SocketIO(app, async_mode="eventlet", message_queue=os.getenv("REDIS_URL"), json=OrjsonModule)
 
 serper_api_key = os.getenv("SERPER_API_KEY")
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 
+# Finished generations keyed by their inputs, so repeated requests skip the LLM calls
+cache = diskcache.Cache(os.getenv("LLM_CACHE_DIR", "./llm_cache"))
+CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+# Part of every cache key; bump it whenever the prompts, model or result format change
+CACHE_VERSION = "4"
+
+# Set to run the original researcher + writer crew instead of the single structured-output task
+TWO_AGENT_CREW = os.getenv("TWO_AGENT_CREW", "").lower() in ("1", "true", "yes")
+
+# Generations run on a fixed number of workers; once too many are queued, new ones are refused
+workers = Semaphore(int(os.getenv("GEN_WORKERS", "4")))
+pending = BoundedSemaphore(int(os.getenv("GEN_MAX_PENDING", "100")))
+
+# The prompts below are identical for every request. CrewAI sends the agent's role, backstory,
+# goal and tools as the system message and the task description and expected output after it,
+# so agents are kept fully static and the request-specific details are appended only at the
+# end of each task. This only prepares the prompts for prefix caching: gemini-1.5-pro has no
+# implicit caching and these prompts are below its explicit-cache minimum, so there is no
+# caching gain until the model is switched to one that caches stable prefixes implicitly.
+RESEARCHER_GOAL = 'Conduct an in-depth, authoritative analysis of cutting-edge developments in the topic you are given'
+
+WRITER_GOAL = 'Craft a compelling, authoritative piece of content on the topic you are given, tailored for its target audience'
+
+STRATEGIST_GOAL = 'Research the topic you are given in depth and turn the findings into compelling content for its target audience'
+
+RESEARCHER_BACKSTORY = (
+    "You are a world-renowned Expert Research Analyst whose expertise is sought after by "
+    "leading organizations and publications worldwide. "
+    "You have a track record of identifying emerging trends before they become mainstream and "
+    "providing nuanced insights that drive strategic decision-making. "
+    "Your analytical skills are complemented by your ability to synthesize complex information "
+    "from diverse sources, including academic papers, industry reports, and expert interviews."
+)
+
+WRITER_BACKSTORY = (
+    "You are an award-winning Senior Content Strategist with a proven track record in creating "
+    "high-impact content across various industries. Your expertise lies in translating complex "
+    "topics into engaging narratives that resonate with specific audience segments. "
+    "You have a deep understanding of content marketing principles and a keen eye for storytelling. "
+    "Your work has been featured in leading publications, and you're known for your ability to "
+    "adapt your writing style to any topic or audience while maintaining a consistent brand voice."
+)
+
+RESEARCH_INSTRUCTIONS = (
+    "Conduct a comprehensive, multi-faceted analysis of the latest advancements in the topic given below. Your research should:\n"
+    "1. Identify and evaluate key trends, breakthrough technologies, and potential industry impacts.\n"
+    "2. Analyze market dynamics, including major players, market size, and growth projections.\n"
+    "3. Assess the regulatory landscape and its implications on the development of the topic.\n"
+    "4. Examine case studies or real-world applications that demonstrate the practical impact of these advancements.\n"
+    "5. Consider potential challenges or limitations in the field and how they might be addressed.\n"
+    "6. Explore the broader societal, economic, or ethical implications of these developments.\n"
+    "Compile your findings in a detailed, well-structured report with clear sections and subsections. "
+    "Ensure all claims are substantiated with credible sources or data points. "
+    "Before finalizing, review your draft to ensure it meets the highest standards of accuracy, comprehensiveness, and clarity.\n"
+)
+
+RESEARCH_EXPECTED_OUTPUT = (
+    "A comprehensive, authoritative report on the latest advancements in the topic, structured with clear sections including "
+    "an executive summary, market overview, key trends, industry analysis, regulatory landscape, case studies, "
+    "challenges and limitations, broader implications, and a future outlook."
+)
+
+WRITING_INSTRUCTIONS = (
+    "Using the insights from the research report, develop an engaging and authoritative piece in the content type given below, "
+    "tailored specifically for the target audience given below. Your content should:\n"
+    "1. Adopt the given tone throughout, ensuring it's appropriate for the target audience and the content format.\n"
+    "2. Begin with a compelling hook that immediately captures the audience's attention.\n"
+    "3. Clearly articulate the significance of the topic to the target audience, emphasizing relevance and potential impact.\n"
+    "4. Distill complex concepts into accessible language without losing depth or accuracy.\n"
+    "5. Incorporate relevant data, statistics, or expert quotes to support key points.\n"
+    "6. Use appropriate structural elements (headings, subheadings, bullet points) to enhance readability.\n"
+    "7. Include practical takeaways or actionable insights that provide value to the target audience.\n"
+    "8. Conclude with a powerful closing statement that reinforces the main message and leaves a lasting impression.\n"
+    "9. Ensure the content length and depth are appropriate for the chosen content type.\n"
+    "Before finalizing, review your draft for coherence, engagement, and alignment with the target audience's needs and interests.\n"
+)
+
+WRITING_EXPECTED_OUTPUT = (
+    "A compelling, well-structured piece in the chosen content type, tailored for the target audience, with the given tone. "
+    "The content should include an engaging introduction, clearly articulated main points, supporting evidence, "
+    "and a strong conclusion, all formatted appropriately for the chosen content type."
+)
+
+COMBINED_INSTRUCTIONS = (
+    "Complete both of the following steps and return their results together.\n\n"
+    "Step 1 - Research.\n" + RESEARCH_INSTRUCTIONS +
+    "\nStep 2 - Writing.\n" + WRITING_INSTRUCTIONS
+)
+
+COMBINED_EXPECTED_OUTPUT = (
+    "A result with two fields.\n"
+    "research: " + RESEARCH_EXPECTED_OUTPUT + "\n"
+    "article: " + WRITING_EXPECTED_OUTPUT
+)
+
+class GenerationOutput(BaseModel):
+    research: str
+    article: str
+
+# Built once and shared by every crew; only the agents and tasks are created per request
+llm = LLM(model="gemini/gemini-1.5-pro")
+search = SerperDevTool(n_results=4)
+
 def create_crew(topic, content_type, target_audience, tone, sid):
-    llm = "gemini/gemini-1.5-pro"
-    
-    search = SerperDevTool(n_results=4)
+    if TWO_AGENT_CREW:
+        return create_two_agent_crew(topic, content_type, target_audience, tone)
+    return create_single_task_crew(topic, content_type, target_audience, tone)
 
+def create_single_task_crew(topic, content_type, target_audience, tone):
+    strategist = Agent(
+        role='Expert Research Analyst and Senior Content Strategist',
+        goal=STRATEGIST_GOAL,
+        backstory=RESEARCHER_BACKSTORY + " " + WRITER_BACKSTORY,
+        verbose=True,
+        cache=True,
+        llm=llm,
+        allow_delegation=False,
+        tools=[search]
+    )
+
+    # output_pydantic only adds the schema to the prompt and parses the answer; it is not a
+    # provider-side response_schema, and a failed parse costs CrewAI an extra converter call.
+    task = Task(
+        description=COMBINED_INSTRUCTIONS + (
+            f"\nTopic: {topic}\n"
+            f"Content type: {content_type}\n"
+            f"Target audience: {target_audience}\n"
+            f"Tone: {tone}\n"
+            f"You have over 15 years of experience in {topic}."
+        ),
+        expected_output=COMBINED_EXPECTED_OUTPUT + (
+            f"\nThe report covers the latest {topic} advancements; the article is a {content_type} "
+            f"on {topic}, tailored for {target_audience}, with a {tone} tone."
+        ),
+        output_pydantic=GenerationOutput,
+        agent=strategist,
+    )
+
+    crew = Crew(
+        agents=[strategist],
+        tasks=[task],
+        process=Process.sequential,
+        cache=False,
+        verbose=True,
+    )
+
+    return crew
+
+def create_two_agent_crew(topic, content_type, target_audience, tone):
     researcher = Agent(
         role='Expert Research Analyst',
-        goal=f'Conduct an in-depth, authoritative analysis of cutting-edge developments in {topic}',
-        backstory=(
-            f"You are a world-renowned Expert Research Analyst with over 15 years of experience in {topic}. "
-            f"Your expertise is sought after by leading organizations and publications worldwide. "
-            f"You have a track record of identifying emerging trends before they become mainstream and "
-            f"providing nuanced insights that drive strategic decision-making. "
-            f"Your analytical skills are complemented by your ability to synthesize complex information "
-            f"from diverse sources, including academic papers, industry reports, and expert interviews."
-        ),
+        goal=RESEARCHER_GOAL,
+        backstory=RESEARCHER_BACKSTORY,
         verbose=True,
         cache=True,
         llm=llm,
@@ -37,15 +216,8 @@ def create_crew(topic, content_type, target_audience, tone, sid):
 
     writer = Agent(
         role='Senior Content Strategist',
-        goal=f'Craft a compelling, authoritative {content_type} on {topic} tailored for {target_audience}',
-        backstory=(
-            f"You are an award-winning Senior Content Strategist with a proven track record in creating "
-            f"high-impact content across various industries. Your expertise lies in translating complex "
-            f"topics into engaging narratives that resonate with specific audience segments. "
-            f"You have a deep understanding of content marketing principles and a keen eye for storytelling. "
-            f"Your work has been featured in leading publications, and you're known for your ability to "
-            f"adapt your writing style to any topic or audience while maintaining a consistent brand voice."
-        ),
+        goal=WRITER_GOAL,
+        backstory=WRITER_BACKSTORY,
         verbose=True,
         llm=llm,
         allow_delegation=False,
@@ -53,45 +225,23 @@ def create_crew(topic, content_type, target_audience, tone, sid):
     )
 
     task1 = Task(
-        description=(
-            f"Conduct a comprehensive, multi-faceted analysis of the latest advancements in {topic}. Your research should:\n"
-            f"1. Identify and evaluate key trends, breakthrough technologies, and potential industry impacts.\n"
-            f"2. Analyze market dynamics, including major players, market size, and growth projections.\n"
-            f"3. Assess the regulatory landscape and its implications on the development of {topic}.\n"
-            f"4. Examine case studies or real-world applications that demonstrate the practical impact of these advancements.\n"
-            f"5. Consider potential challenges or limitations in the field and how they might be addressed.\n"
-            f"6. Explore the broader societal, economic, or ethical implications of these developments.\n"
-            "Compile your findings in a detailed, well-structured report with clear sections and subsections. "
-            "Ensure all claims are substantiated with credible sources or data points. "
-            "Before finalizing, review your draft to ensure it meets the highest standards of accuracy, comprehensiveness, and clarity."
-        ),
-        expected_output=(
-            f"A comprehensive, authoritative report on the latest {topic} advancements, structured with clear sections including "
-            "an executive summary, market overview, key trends, industry analysis, regulatory landscape, case studies, "
-            "challenges and limitations, broader implications, and a future outlook."
+        description=RESEARCH_INSTRUCTIONS + (
+            f"\nTopic: {topic}\n"
+            f"You have over 15 years of experience in {topic}."
         ),
+        expected_output=RESEARCH_EXPECTED_OUTPUT + f" The report covers the latest {topic} advancements.",
         agent=researcher,
     )
 
     task2 = Task(
-        description=(
-            f"Using the insights from the researcher's report, develop an engaging and authoritative {content_type} on {topic} "
-            f"tailored specifically for {target_audience}. Your content should:\n"
-            f"1. Adopt a {tone} tone throughout, ensuring it's appropriate for the {target_audience} and the {content_type} format.\n"
-            f"2. Begin with a compelling hook that immediately captures the audience's attention.\n"
-            f"3. Clearly articulate the significance of {topic} to the {target_audience}, emphasizing relevance and potential impact.\n"
-            f"4. Distill complex concepts into accessible language without losing depth or accuracy.\n"
-            f"5. Incorporate relevant data, statistics, or expert quotes to support key points.\n"
-            f"6. Use appropriate structural elements (headings, subheadings, bullet points) to enhance readability.\n"
-            f"7. Include practical takeaways or actionable insights that provide value to the {target_audience}.\n"
-            f"8. Conclude with a powerful closing statement that reinforces the main message and leaves a lasting impression.\n"
-            f"9. Ensure the content length and depth are appropriate for the chosen {content_type}.\n"
-            "Before finalizing, review your draft for coherence, engagement, and alignment with the target audience's needs and interests."
+        description=WRITING_INSTRUCTIONS + (
+            f"\nTopic: {topic}\n"
+            f"Content type: {content_type}\n"
+            f"Target audience: {target_audience}\n"
+            f"Tone: {tone}"
         ),
-        expected_output=(
-            f"A compelling, well-structured {content_type} on {topic}, tailored for {target_audience}, with a {tone} tone. "
-            f"The content should include an engaging introduction, clearly articulated main points, supporting evidence, "
-            f"and a strong conclusion, all formatted appropriately for the chosen content type."
+        expected_output=WRITING_EXPECTED_OUTPUT + (
+            f" It is a {content_type} on {topic}, tailored for {target_audience}, with a {tone} tone."
         ),
         agent=writer,
     )
@@ -106,43 +256,94 @@ def create_crew(topic, content_type, target_audience, tone, sid):
 
     return crew
 
+def cache_key(topic, content_type, target_audience, tone):
+    crew_mode = 'two-agent' if TWO_AGENT_CREW else 'single-task'
+    fields = [CACHE_VERSION, crew_mode] + [normalize(v) for v in (topic, content_type, target_audience, tone)]
+    payload = json.dumps(fields)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
 def run_crew(topic, content_type, target_audience, tone, request_id):
     try:
+        key = cache_key(topic, content_type, target_audience, tone)
+        result = cache.get(key)
+        if result is not None:
+            socketio.emit('generation_complete', {'result': result, 'request_id': request_id})
+            return
+
         crew = create_crew(topic, content_type, target_audience, tone, request_id)
         crew_output = crew.kickoff()
         
-        result = {
-            'task_outputs': [],
-            'final_output': str(crew_output)
-        }
-
-        if hasattr(crew_output, 'tasks'):
-            result['task_outputs'] = [
-                {
-                    'task_id': task.task_id,
-                    'output': task.output
-                } for task in crew_output.tasks
-            ]
-        
+        if TWO_AGENT_CREW:
+            result = {
+                'task_outputs': [
+                    {
+                        'task_id': index,
+                        'output': task.raw
+                    } for index, task in enumerate(crew_output.tasks_output, start=1)
+                ],
+                'final_output': str(crew_output)
+            }
+        elif isinstance(crew_output.pydantic, GenerationOutput):
+            result = {
+                'task_outputs': [
+                    {
+                        'task_id': 'research',
+                        'label': 'Research report',
+                        'output': crew_output.pydantic.research
+                    }
+                ],
+                'final_output': crew_output.pydantic.article
+            }
+        else:
+            # Still show the unparsed research+article text, but don't cache it
+            app.logger.warning("Crew output could not be parsed into research and article; sending raw output")
+            result = {
+                'task_outputs': [],
+                'final_output': str(crew_output)
+            }
+            socketio.emit('generation_complete', {'result': result, 'request_id': request_id})
+            return
+
+        cache.set(key, result, expire=CACHE_TTL)
         socketio.emit('generation_complete', {'result': result, 'request_id': request_id})
     except Exception as e:
         app.logger.error(f"Error in background task: {str(e)}")
         socketio.emit('generation_error', {'error': 'An error occurred during content generation.', 'request_id': request_id})
 
+def run_queued(topic, content_type, target_audience, tone, request_id):
+    try:
+        with workers:
+            run_crew(topic, content_type, target_audience, tone, request_id)
+    finally:
+        pending.release()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/generate', methods=['POST'])
 def generate():
-    data = request.json
-    topic = data['topic']
-    content_type = data['contentType']
-    target_audience = data['targetAudience']
-    tone = data['tone']
-    request_id = str(uuid.uuid4())  # Generate a unique ID for this request
-
-    Thread(target=run_crew, args=(topic, content_type, target_audience, tone, request_id)).start()
+    try:
+        data = GenerateRequest.model_validate_json(request.get_data())
+    except ValidationError:
+        return jsonify({'error': 'Invalid request. Please fill in all fields.'}), 400
+
+    topic = data.topic
+    content_type = data.content_type
+    target_audience = data.target_audience
+    tone = data.tone
+    request_id = uuid.uuid4().hex  # Generate a unique ID for this request
+
+    # Cached results are sent straight away, without waiting for a queue slot or a worker
+    result = cache.get(cache_key(topic, content_type, target_audience, tone))
+    if result is not None:
+        socketio.emit('generation_complete', {'result': result, 'request_id': request_id})
+        return jsonify({'message': 'Generation complete', 'request_id': request_id}), 200
+
+    if not pending.acquire(blocking=False):
+        return jsonify({'error': 'Too many generations in progress. Please try again later.'}), 429
+
+    socketio.start_background_task(run_queued, topic, content_type, target_audience, tone, request_id)
     return jsonify({'message': 'Generation started', 'request_id': request_id}), 202
 
 @socketio.on('connect')
@@ -51,10 +51,15 @@ document.addEventListener('DOMContentLoaded', function() {
             body: JSON.stringify(formData),
         })
         .then(response => {
-            if (!response.ok) {
-                throw new Error('Network response was not ok');
-            }
-            return response.json();
+            // Error responses (400, 429) carry a JSON body with a user-facing message
+            return response.json()
+                .catch(() => ({}))
+                .then(data => {
+                    if (!response.ok) {
+                        throw new Error(data.error || 'Network response was not ok');
+                    }
+                    return data;
+                });
         })
         .then(data => {
             if (data.error) {
@@ -79,7 +84,8 @@ document.addEventListener('DOMContentLoaded', function() {
         formattedResult += `<h3>Final Output:</h3><div>${data.result.final_output}</div>`;
         formattedResult += '<h3>Task Outputs:</h3>';
         data.result.task_outputs.forEach(task => {
-            formattedResult += `<h4>Task ${task.task_id}:</h4><div>${task.output}</div>`;
+            const heading = task.label || `Task ${task.task_id}`;
+            formattedResult += `<h4>${heading}:</h4><div>${task.output}</div>`;
         });
         
         result.innerHTML = formattedResult;